@@ -1,46 +1,218 @@
 #!/usr/bin/env python
 
 import os.path
+import io
 import sys
+import shutil
 import tempfile
-import glob
-import json
+import hashlib
+import argparse
+import queue
+import sqlite3
+import threading
+import multiprocessing
+from collections import deque, namedtuple
 from pathlib import Path
-from json.decoder import JSONDecodeError
 import urllib
 
 import platformdirs
+import psutil
+
+from concurrent.futures import ThreadPoolExecutor
 
 # Disable YOLO output
 os.environ['YOLO_VERBOSE'] = 'False'
+
+# Pin the math libraries to the physical cores before torch is imported:
+# hyperthreads and oversized OpenMP pools hurt CPU inference latency
+PHYSICAL_CORES = psutil.cpu_count(logical=False) or os.cpu_count() or 1
+os.environ.setdefault('OMP_NUM_THREADS', str(PHYSICAL_CORES))
+os.environ.setdefault('MKL_NUM_THREADS', str(PHYSICAL_CORES))
+os.environ.setdefault('KMP_AFFINITY', 'granularity=fine,compact,1,0')
+
+import cv2
+import numpy as np
+import orjson
+import torch
 from ultralytics import YOLO
 
 WEIGHTS_DIRECTORY = os.path.join(platformdirs.user_cache_dir('gbif-scraper', ensure_exists=True))
 WEIGHTS_PATH = os.path.join(WEIGHTS_DIRECTORY, 'weights.pt')
 WEIGHTS_URL = "https://github.com/edgaremy/quick-detector/raw/refs/heads/main/models/arthropod_dectector_wave18_best.pt"
 
+# TensorRT engine exported from the weights, and the parameters it was built with
+ENGINE_PATH = os.path.join(WEIGHTS_DIRECTORY, 'weights.engine')
+ENGINE_STAMP_PATH = os.path.join(WEIGHTS_DIRECTORY, 'weights.engine.stamp')
+IMG_SIZE = 640
+
+# Number of scratch directories recycled for the batch outputs
+RING_SIZE = 4
+
+CUDA = torch.cuda.is_available()
+DEVICE = 0 if CUDA else 'cpu'
+HALF = CUDA
+
+if not CUDA:
+    torch.set_num_threads(PHYSICAL_CORES)
+    torch.set_num_interop_threads(1)
+
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs, flush=True)
 
 
+def weights_sha():
+    sha = hashlib.sha256()
+    with open(WEIGHTS_PATH, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def decode_image(path):
+    # Decoding is parallelized at the executor level, don't let OpenCV spawn
+    # its own threads on top of it
+    cv2.setNumThreads(0)
+    return cv2.imread(path, cv2.IMREAD_COLOR)
+
+
+def letterbox(image):
+    # Resize to IMG_SIZE preserving the aspect ratio and pad the rest, like
+    # ultralytics would, so its own letterbox becomes a no-op on the main
+    # thread and the resize runs on the decode workers instead
+    height, width = image.shape[:2]
+    scale = min(IMG_SIZE / width, IMG_SIZE / height)
+
+    # Extreme aspect ratios can round a dimension down to 0, which
+    # cv2.resize refuses: clamp to a 1-pixel strip instead
+    new_width = max(1, round(width * scale))
+    new_height = max(1, round(height * scale))
+    pad_x = (IMG_SIZE - new_width) // 2
+    pad_y = (IMG_SIZE - new_height) // 2
+
+    boxed = np.full((IMG_SIZE, IMG_SIZE, 3), 114, dtype=np.uint8)
+    boxed[pad_y:pad_y + new_height, pad_x:pad_x + new_width] = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+
+    return boxed, scale, pad_x, pad_y
+
+
+def decode_letterbox(path):
+    image = decode_image(path)
+
+    if image is None:
+        return None
+
+    return (image, *letterbox(image))
+
+
+def write_crop(image, box, path):
+    # box is the xywh of the center of the bounding box
+    x, y, w, h = box
+    x1 = max(int(x - w / 2), 0)
+    y1 = max(int(y - h / 2), 0)
+    x2 = min(int(x + w / 2), image.shape[1])
+    y2 = min(int(y + h / 2), image.shape[0])
+
+    if x2 <= x1 or y2 <= y1:
+        return False
+
+    return cv2.imwrite(path, image[y1:y2, x1:x2], [cv2.IMWRITE_JPEG_QUALITY, 90])
+
+
+def decode_batch(decoder, batch, out, micro_batch):
+    # Keep a bounded window of in-flight decodes: out.put blocks when the
+    # consumer lags, which stalls submission instead of decoding the whole
+    # batch into memory
+    window = deque()
+
+    def drain(request, future):
+        # A raising decode must not kill the producer: hand the consumer the
+        # same (request, None) item a failed decode produces
+        try:
+            out.put((request, future.result()))
+        except Exception as e:
+            eprint(f"python error: failed to decode {request.path}: {e}")
+            out.put((request, None))
+
+    try:
+        for request in batch:
+            window.append((request, decoder.submit(decode_letterbox, request.path)))
+
+            if len(window) >= 2 * micro_batch:
+                drain(*window.popleft())
+
+        while window:
+            drain(*window.popleft())
+    finally:
+        # The consumer blocks on the queue, it must always see the sentinel
+        out.put(None)
+
+
+def load_pytorch_model():
+    # Fusing conv+bn once at load time speeds up every forward
+    model = YOLO(WEIGHTS_PATH)
+    model.fuse()
+    return model
+
+
+def export_engine(micro_batch):
+    # Re-export the engine if it is missing or was built from other weights
+    # or another batch size, and return True if an engine is available
+    wanted_stamp = f'{weights_sha()} batch={micro_batch}'
+    stamp = None
+    if os.path.exists(ENGINE_STAMP_PATH):
+        with open(ENGINE_STAMP_PATH) as f:
+            stamp = f.read().strip()
+
+    if not os.path.exists(ENGINE_PATH) or stamp != wanted_stamp:
+        eprint('exporting weights to tensorrt engine')
+        try:
+            YOLO(WEIGHTS_PATH).export(format='engine', half=True, dynamic=True, batch=micro_batch, imgsz=IMG_SIZE)
+        except Exception as e:
+            eprint(f"python error: failed to export tensorrt engine, falling back to pytorch: {e}")
+            return False
+
+        with open(ENGINE_STAMP_PATH, 'w') as f:
+            f.write(wanted_stamp)
+
+        eprint('tensorrt engine exported')
+
+    return True
+
+
+def load_model(micro_batch):
+    # On CPU hosts there is no TensorRT, run the PyTorch weights directly
+    if not CUDA:
+        return load_pytorch_model()
+
+    if not export_engine(micro_batch):
+        return load_pytorch_model()
+
+    try:
+        return YOLO(ENGINE_PATH, task='detect')
+    except Exception as e:
+        eprint(f"python error: failed to load tensorrt engine, falling back to pytorch: {e}")
+        return load_pytorch_model()
+
+
 class Request:
+    __slots__ = ()
+
     @staticmethod
     def parse(json_data):
-        ty = json_data.get('type', None)
-
-        if ty == 'add_file':
-            return AddFile(json_data)
-        elif ty == 'run':
-            return Run(json_data)
-        elif ty == 'end':
-            return End(json_data)
-        else:
-            eprint(f"unknown message type: {ty}")
+        # One dict lookup per request instead of a chain of string compares
+        cls = REQUEST_TYPES.get(json_data.get('type', None))
+
+        if cls is None:
+            eprint(f"unknown message type: {json_data.get('type', None)}")
             return None
 
+        return cls(json_data)
+
 
 class AddFile(Request):
+    __slots__ = ('ty', 'id', 'path')
+
     def __init__(self, json_data):
         self.ty = 'add_file'
         self.id = json_data['id']
@@ -51,6 +223,8 @@ class AddFile(Request):
 
 
 class Run(Request):
+    __slots__ = ('ty',)
+
     def __init__(self, json_data):
         self.ty = 'run'
 
@@ -59,6 +233,8 @@ class Run(Request):
 
 
 class End(Request):
+    __slots__ = ('ty',)
+
     def __init__(self, json_data):
         self.ty = 'end'
 
@@ -66,14 +242,22 @@ class End(Request):
         return f"End()"
 
 
+REQUEST_TYPES = {'add_file': AddFile, 'run': Run, 'end': End}
+
+# What the batch keeps of an add_file request: a bare tuple instead of the
+# parsed dict plus an AddFile wrapper, which matters when a client streams
+# thousands of files
+BatchEntry = namedtuple('BatchEntry', ('id', 'path'))
+
+
 class Response:
     def to_json(self):
-        return json.dumps(self.__dict__)
+        return orjson.dumps(self.__dict__)
 
 
 class Ready:
     def to_json(self):
-        return '{"type": "ready"}'
+        return b'{"type": "ready"}'
 
 
 class Batch:
@@ -82,7 +266,12 @@ class Batch:
         self.files = []
 
     def to_json(self):
-        return f'{{"type": "batch", "id": {self.id}, "files": [' + ','.join([x.to_json() for x in self.files]) + ']}'
+        return orjson.dumps({'type': 'batch', 'id': self.id, 'files': [x.__dict__ for x in self.files]})
+
+
+def emit(response):
+    sys.stdout.buffer.write(response.to_json() + b'\n')
+    sys.stdout.buffer.flush()
 
 
 class FileCropSuccess(Response):
@@ -105,7 +294,332 @@ class FileCropFailure(Response):
         self.path = path
 
 
-def main(tmp_root):
+def warmup(model, micro_batch):
+    # Kernel selection and cudnn autotune happen on the first forward of each
+    # shape: pay for them now instead of on the first real batch
+    dummy = np.zeros((IMG_SIZE, IMG_SIZE, 3), dtype=np.uint8)
+
+    try:
+        with torch.inference_mode():
+            model.predict([dummy] * micro_batch, max_det=1, device=DEVICE, half=HALF, verbose=False)
+    except Exception as e:
+        eprint(f"python error: warmup failed: {e}")
+
+
+def compile_model(model, micro_batch):
+    # Without TensorRT, torch.compile still buys fused kernels. Wrapping
+    # model.model before the first predict is useless: AutoBackend re-fuses
+    # the module it is handed, which unwraps an OptimizedModule back to the
+    # eager one. Compile the module the predictor actually runs, which exists
+    # once warmup() has built it
+    if not hasattr(torch, 'compile'):
+        return
+
+    predictor = getattr(model, 'predictor', None)
+
+    # Only the PyTorch backend has a module to compile
+    if predictor is None or not getattr(predictor.model, 'pt', False):
+        return
+
+    try:
+        predictor.model.model = torch.compile(predictor.model.model, mode='reduce-overhead', dynamic=False)
+    except Exception as e:
+        eprint(f"python error: failed to compile model, running eager: {e}")
+        return
+
+    # Warm again so the graph is captured before the first real batch
+    warmup(model, micro_batch)
+
+
+class Staging:
+    # Two pinned host buffers, alternated between chunks so the upload of one
+    # chunk can overlap with the compute of the previous one
+    def __init__(self, micro_batch):
+        self.buffers = [
+            torch.empty((micro_batch, 3, IMG_SIZE, IMG_SIZE), dtype=torch.uint8, pin_memory=True)
+            for _ in range(2)
+        ]
+        self.index = 0
+
+    def upload(self, boxeds):
+        buffer = self.buffers[self.index]
+        self.index = (self.index + 1) % 2
+
+        # The model expects RGB CHW; staging through pinned memory lets the
+        # host to device copy run asynchronously
+        for i, boxed in enumerate(boxeds):
+            buffer[i] = torch.from_numpy(np.ascontiguousarray(boxed[..., ::-1].transpose(2, 0, 1)))
+
+        return buffer[:len(boxeds)].to(DEVICE, non_blocking=True).float().div_(255)
+
+
+def crop_chunk(model, requests, images, boxeds, metas, tmp_dir, staging):
+    # inference_mode drops autograd bookkeeping; stream=True keeps ultralytics
+    # from buffering Results on top of the chunk we hold here
+    with torch.inference_mode():
+        try:
+            source = staging.upload(boxeds) if staging is not None else boxeds
+            predicts = list(model.predict(source, stream=True, max_det=1, device=DEVICE, half=HALF, verbose=False))
+
+            # Move every box and confidence to the CPU in one transfer instead
+            # of two GPU syncs per image; asynchronous CUDA errors from the
+            # forward also surface on this sync
+            rows = [torch.cat((p.boxes[0].xywh[0], p.boxes[0].conf)) for p in predicts if len(p.boxes) > 0]
+            detections = torch.stack(rows).cpu().numpy() if rows else None
+        except Exception as e:
+            eprint(f"python error: failed to crop batch: {e}")
+            return [FileCropFailure(req.id, req.path) for req in requests]
+
+    responses = []
+    hit = 0
+
+    for index, (req, predict) in enumerate(zip(requests, predicts)):
+        if len(predict.boxes) > 0:
+            x, y, width, height = detections[hit][:4].tolist()
+            confidence = float(detections[hit][4])
+            hit += 1
+
+            # The detection is in letterboxed coordinates, bring it back to
+            # the original image
+            scale, pad_x, pad_y = metas[index]
+            box = [(x - pad_x) / scale, (y - pad_y) / scale, width / scale, height / scale]
+
+            # Crop the already decoded image ourselves instead of letting
+            # ultralytics re-decode and re-encode the source file
+            cropped = os.path.join(tmp_dir, f'{req.id}_{Path(req.path).stem}.jpg')
+
+            if not write_crop(images[index], box, cropped):
+                eprint(f"python error: failed to write crop for {req.path}")
+                continue
+
+            response = FileCropSuccess(req.id, req.path, cropped, box, confidence)
+        else:
+            response = FileCropFailure(req.id, req.path)
+
+        responses.append(response)
+
+    return responses
+
+
+def process_shard(model, decoder, shard, tmp_dir, micro_batch, staging):
+    responses = []
+
+    # Decode in the background so the GPU can start on the first images while
+    # the rest of the shard is still being read
+    decoded = queue.Queue(maxsize=2 * micro_batch)
+    producer = threading.Thread(target=decode_batch, args=(decoder, shard, decoded, micro_batch), daemon=True)
+    producer.start()
+
+    done = False
+
+    while not done:
+        requests = []
+        images = []
+        boxeds = []
+        metas = []
+
+        while len(images) < micro_batch:
+            item = decoded.get()
+
+            if item is None:
+                done = True
+                break
+
+            req, decoded_item = item
+
+            if decoded_item is None:
+                eprint(f"python error: failed to decode {req.path}")
+                responses.append(FileCropFailure(req.id, req.path))
+            else:
+                image, boxed, scale, pad_x, pad_y = decoded_item
+                requests.append(req)
+                images.append(image)
+                boxeds.append(boxed)
+                metas.append((scale, pad_x, pad_y))
+
+        if len(images) == 0:
+            continue
+
+        responses.extend(crop_chunk(model, requests, images, boxeds, metas, tmp_dir, staging))
+
+    producer.join()
+
+    return responses
+
+
+def crop_cached(decoder, hits, tmp_dir):
+    # Rebuild the crops of cached detections without going through the model
+    responses = []
+
+    for (req, (x, y, width, height, confidence)), image in zip(hits, decoder.map(decode_image, [req.path for req, _ in hits])):
+        if image is None:
+            eprint(f"python error: failed to decode {req.path}")
+            responses.append(FileCropFailure(req.id, req.path))
+            continue
+
+        box = [x, y, width, height]
+        cropped = os.path.join(tmp_dir, f'{req.id}_{Path(req.path).stem}.jpg')
+
+        if not write_crop(image, box, cropped):
+            eprint(f"python error: failed to write crop for {req.path}")
+            continue
+
+        responses.append(FileCropSuccess(req.id, req.path, cropped, box, confidence))
+
+    return responses
+
+
+def replica_worker(index, jobs, results, replicas, micro_batch):
+    # CUDA_VISIBLE_DEVICES was pinned before the spawn, device 0 is ours
+    torch.backends.cudnn.benchmark = True
+
+    model = None
+    staging = None
+
+    try:
+        model = load_model(micro_batch)
+        warmup(model, micro_batch)
+        compile_model(model, micro_batch)
+        staging = Staging(micro_batch)
+    except Exception as e:
+        eprint(f"python error: replica {index} failed to load model: {e}")
+
+    # Split the decoding threads between the replicas
+    decoder = ThreadPoolExecutor(max_workers=max(1, (os.cpu_count() or 1) // replicas))
+
+    while True:
+        job = jobs.get()
+
+        if job is None:
+            return
+
+        shard, tmp_dir = job
+
+        # Whatever happens, the parent must receive one response list per
+        # dispatched shard or the whole scraper stalls on the batch
+        try:
+            if model is None:
+                raise RuntimeError('model is not loaded')
+
+            responses = process_shard(model, decoder, shard, tmp_dir, micro_batch, staging)
+        except Exception as e:
+            eprint(f"python error: replica {index} failed to process shard: {e}")
+            responses = [FileCropFailure(req.id, req.path) for req in shard]
+
+        results.put((index, responses))
+
+
+class ReplicaPool:
+    # One model replica per GPU, each in its own process with an independent
+    # CUDA context
+    def __init__(self, replicas, micro_batch):
+        # Export once before spawning so the replicas don't race on it
+        export_engine(micro_batch)
+
+        ctx = multiprocessing.get_context('spawn')
+        self.replicas = replicas
+        self.jobs = [ctx.Queue() for _ in range(replicas)]
+        self.results = ctx.Queue()
+        self.processes = []
+
+        for index in range(replicas):
+            # spawn copies the environment: pin the replica to its device
+            # before torch initializes CUDA in the child
+            os.environ['CUDA_VISIBLE_DEVICES'] = str(index)
+            process = ctx.Process(target=replica_worker, args=(index, self.jobs[index], self.results, replicas, micro_batch), daemon=True)
+            process.start()
+            self.processes.append(process)
+
+        os.environ.pop('CUDA_VISIBLE_DEVICES', None)
+
+    def crop_batch(self, batch, tmp_dir):
+        # Round-robin the batch over the replicas
+        shards = [batch[index::self.replicas] for index in range(self.replicas)]
+        pending = {}
+
+        for index, shard in enumerate(shards):
+            if len(shard) > 0:
+                self.jobs[index].put((shard, tmp_dir))
+                pending[index] = shard
+
+        # Collect the shards, failing the ones whose replica can no longer
+        # answer instead of blocking on the queue forever
+        by_id = {}
+
+        while pending:
+            try:
+                index, responses = self.results.get(timeout=1)
+            except queue.Empty:
+                for index in list(pending):
+                    if not self.processes[index].is_alive():
+                        eprint(f"python error: replica {index} died, failing its shard")
+
+                        for req in pending.pop(index):
+                            by_id[req.id] = FileCropFailure(req.id, req.path)
+                continue
+
+            for response in responses:
+                by_id[response.id] = response
+
+            pending.pop(index, None)
+
+        # Restore the original batch order
+        return [by_id[request.id] for request in batch if request.id in by_id]
+
+    def end(self):
+        for jobs in self.jobs:
+            jobs.put(None)
+
+        for process in self.processes:
+            process.join()
+
+
+class ResultCache:
+    # Remembers detections per (weights sha, path, mtime) so re-processing the
+    # same image sets does not run the model again
+    def __init__(self):
+        self.sha = weights_sha()
+        self.db = sqlite3.connect(os.path.join(WEIGHTS_DIRECTORY, 'cache.db'))
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'weights_sha TEXT NOT NULL, path TEXT NOT NULL, mtime INTEGER NOT NULL, '
+            'x REAL, y REAL, width REAL, height REAL, confidence REAL, '
+            'PRIMARY KEY (weights_sha, path, mtime))'
+        )
+        self.db.commit()
+
+    def lookup(self, path):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+        return self.db.execute(
+            'SELECT x, y, width, height, confidence FROM results WHERE weights_sha = ? AND path = ? AND mtime = ?',
+            (self.sha, path, mtime),
+        ).fetchone()
+
+    def store(self, responses):
+        # Only successes are cached: a failure can be transient (unreadable
+        # file, chunk error) and should be retried on the next run
+        for response in responses:
+            if response.type != 'file_crop_success':
+                continue
+
+            try:
+                mtime = os.stat(response.path).st_mtime_ns
+            except OSError:
+                continue
+
+            self.db.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (self.sha, response.path, mtime, response.x, response.y, response.width, response.height, response.confidence),
+            )
+
+        self.db.commit()
+
+
+def main(tmp_root, micro_batch):
     # Download YOLO weights if not present
     if not os.path.exists(WEIGHTS_PATH):
         eprint('weights not found, downloading')
@@ -124,78 +638,139 @@ def main(tmp_root):
 
     os.makedirs(tmp_root, exist_ok=True)
 
-    model = YOLO(WEIGHTS_PATH)
+    # A small ring of scratch directories recycled between batches, so long
+    # sessions don't accumulate directory entries under tmp_root
+    ring = [os.path.join(tmp_root, str(index)) for index in range(RING_SIZE)]
+
+    # With several GPUs, shard each batch over one replica per device;
+    # otherwise run the model in-process
+    replicas = torch.cuda.device_count() if CUDA else 0
+
+    if replicas > 1:
+        pool = ReplicaPool(replicas, micro_batch)
+        model = None
+        staging = None
+    else:
+        pool = None
+
+        if CUDA:
+            torch.backends.cudnn.benchmark = True
+
+        model = load_model(micro_batch)
+        warmup(model, micro_batch)
+        compile_model(model, micro_batch)
+        staging = Staging(micro_batch) if CUDA else None
+
+    # Decodes images for in-process inference and rebuilds crops on cache hits
+    decoder = ThreadPoolExecutor(max_workers=os.cpu_count())
+    cache = ResultCache()
 
     batch_counter = 0
     batch = []
 
     eprint('python is ready')
-    print(Ready().to_json())
+    emit(Ready())
 
-    while True:
-        try:
-            request_str = input()
-        except EOFError:
-            return
+    # Read requests on the binary buffer: one big read syscall covers many
+    # lines, and orjson parses the raw bytes without a unicode roundtrip
+    reader = io.BufferedReader(sys.stdin.buffer.raw, buffer_size=1 << 20)
 
+    for raw in reader:
         try:
-            request_object = json.loads(request_str)
-        except JSONDecodeError:
-            eprint(f"failed to parse json: {request_str}")
+            request_object = orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            eprint(f"failed to parse json: {raw}")
+            continue
+
+        # add_file is the hot path, skip the Request wrapper entirely
+        if request_object.get('type', None) == 'add_file':
+            batch.append(BatchEntry(request_object['id'], request_object['path']))
             continue
 
         request = Request.parse(request_object)
 
-        if request.ty == 'add_file':
-            batch.append(request)
+        if request is None:
+            continue
 
-        elif request.ty == 'run' or request.ty == 'end':
+        if request.ty == 'run' or request.ty == 'end':
 
             if len(batch) > 0:
                 batch_response = Batch(batch_counter)
 
-                images = list(map(lambda x: x.path, batch))
-                tmp_dir = os.path.join(tmp_root, str(batch_counter))
+                # The server moves the crops out of the slot as soon as it
+                # receives the batch response, so by the time a slot comes
+                # around again only leftovers remain: wipe them before reuse
+                tmp_dir = ring[batch_counter % RING_SIZE]
+                shutil.rmtree(tmp_dir, ignore_errors=True)
                 os.makedirs(tmp_dir, exist_ok=True)
-                try:
-                    predicts = model.predict(images, save_crop=True, show=False, save=False, save_txt=False, max_det=1, project=tmp_dir)
-                except Exception as e:
-                    eprint(f"python error: failed to crop batch: {e}")
 
-                    # Send empty batch
-                    print(batch_response.to_json(), flush=True)
-                    batch = []
-                    batch_counter += 1
-                    continue
+                # Retries can queue the same file several times: infer once
+                # per unique path and fan the result back to every request
+                uniques = list({req.path: req for req in batch}.values())
 
-                for index, (request, predict) in enumerate(zip(batch, predicts)):
+                # Serve what the cache already knows, only infer the rest
+                hits = []
+                misses = []
 
-                    if len(predict.boxes) > 0:
-                        box = predict.boxes[0].xywh[0].tolist()
-                        confidence = predict.boxes[0].conf.tolist()[0]
-                        filename = Path(request.path).stem
+                for req in uniques:
+                    cached = cache.lookup(req.path)
 
-                        files = glob.glob(f'{tmp_dir}/**/{filename}.*', recursive=True)
-
-                        # Find cropped media in directory
-                        if len(files) == 0:
-                            eprint(f"python error: crop succeeded but file was not created for {filename}")
-                            continue
+                    if cached is None:
+                        misses.append(req)
+                    else:
+                        hits.append((req, cached))
 
-                        response = FileCropSuccess(request.id, request.path, files[0], box, confidence)
+                if len(misses) > 0:
+                    if pool is not None:
+                        responses = pool.crop_batch(misses, tmp_dir)
                     else:
-                        response = FileCropFailure(request.id, request.path)
+                        responses = process_shard(model, decoder, misses, tmp_dir, micro_batch, staging)
+
+                        if CUDA:
+                            torch.cuda.empty_cache()
+
+                    cache.store(responses)
+                else:
+                    responses = []
+
+                responses += crop_cached(decoder, hits, tmp_dir)
+
+                by_path = {response.path: response for response in responses}
+                seen = set()
+
+                for req in batch:
+                    response = by_path.get(req.path)
+
+                    if response is None or req.id in seen:
+                        continue
+
+                    seen.add(req.id)
+
+                    if response.id != req.id:
+                        # Another media with the same file: reuse its result
+                        if response.type == 'file_crop_success':
+                            response = FileCropSuccess(req.id, req.path, response.cropped_path, [response.x, response.y, response.width, response.height], response.confidence)
+                        else:
+                            response = FileCropFailure(req.id, req.path)
 
                     batch_response.files.append(response)
 
-                print(batch_response.to_json(), flush=True)
+                emit(batch_response)
 
                 batch = []
                 batch_counter += 1
 
             if request.ty == 'end':
-                return
+                break
+
+    if pool is not None:
+        pool.end()
 
 
 if __name__ == '__main__':
-    main(sys.argv[1])
+    parser = argparse.ArgumentParser(description='Crops images around the arthropods detected by the YOLO model.')
+    parser.add_argument('tmp_root', help='directory where cropped images are written')
+    parser.add_argument('--micro-batch', type=int, default=8, help='number of images per inference call')
+    args = parser.parse_args()
+
+    main(args.tmp_root, args.micro_batch)
@@ -4,7 +4,7 @@ use std::process::Stdio;
 
 use serde::{Deserialize, Serialize};
 
-use tokio::fs::{remove_dir_all, rename};
+use tokio::fs::rename;
 use tokio::io::{AsyncBufReadExt, AsyncWriteExt, BufReader};
 use tokio::process::{ChildStdin, ChildStdout, Command};
 use tokio::sync::mpsc::UnboundedReceiver;
@@ -326,9 +326,6 @@ impl Cropper {
             )
         }
 
-        // Clean batch tmp files
-        remove_dir_all(self.config.storage.tmp_dir().join(format!("{}", batch.id))).await?;
-
         info!(
             "Python successfully cropped {} out of {} images",
             batch.files.len() - failures.len(),